@@ -1,10 +1,134 @@
-import ldmud, sys, collections, dataclasses, time
+import ldmud, sys, array, collections, dataclasses, heapq, mmap, os, struct, time
+from . import records
 
 time_ns = getattr(time, 'time_ns', None)
 if not time_ns:
     def time_ns():
         return int(time.time()*1000000)
 
+class profile_node:
+    """
+    A node in the calling-context tree, representing the calls
+    to a function from a specific call path.
+    """
+    def __init__(self, parent, program_name, function_name, line_number):
+        self.parent = parent
+        self.program_name = program_name
+        self.function_name = function_name
+        self.line_number = line_number    # Line of the call in the calling function
+        self.calls = 0
+        self.cost = 0                     # Eval cost including called functions
+        self.time = 0                     # Elapsed time in nanoseconds including called functions
+        self.exclusive_cost = 0           # Eval cost without called functions
+        self.exclusive_time = 0           # Elapsed time in nanoseconds without called functions
+        self.children = {}                # (program_name, function_name, line_number): profile_node
+
+    def get_child(self, program_name, function_name, line_number):
+        key = (program_name, function_name, line_number,)
+        child = self.children.get(key)
+        if child is None:
+            child = profile_node(self, program_name, function_name, line_number)
+            self.children[key] = child
+        return child
+
+    def walk(self):
+        """
+        Yields this node and all its descendants in preorder.
+        """
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            yield node
+            pending.extend(reversed(list(node.children.values())))
+
+    def merge(self, other):
+        """
+        Adds the information from <other> and its descendants.
+        """
+        pending = [(self, other,)]
+        while pending:
+            node, other_node = pending.pop()
+            node.calls += other_node.calls
+            node.cost += other_node.cost
+            node.time += other_node.time
+            node.exclusive_cost += other_node.exclusive_cost
+            node.exclusive_time += other_node.exclusive_time
+            for other_child in other_node.children.values():
+                pending.append((node.get_child(other_child.program_name, other_child.function_name, other_child.line_number), other_child,))
+
+    def lpc_get_program_name(self) -> str:
+        return self.program_name
+
+    def lpc_get_function_name(self) -> str:
+        return self.function_name
+
+    def lpc_get_line_number(self) -> int:
+        return self.line_number
+
+    def lpc_get_calls(self) -> int:
+        return self.calls
+
+    def lpc_get_cost(self) -> int:
+        return self.cost
+
+    def lpc_get_time(self) -> int:
+        return self.time
+
+    def lpc_get_exclusive_cost(self) -> int:
+        return self.exclusive_cost
+
+    def lpc_get_exclusive_time(self) -> int:
+        return self.exclusive_time
+
+    def lpc_get_parent(self):
+        return self.parent
+
+    def lpc_get_children(self):
+        return ldmud.Array(sorted(self.children.values(), key=lambda node: node.cost, reverse=True))
+
+    def lpc_get_path(self):
+        path = []
+        node = self
+        while node.parent is not None:
+            path.append(node)
+            node = node.parent
+        return ldmud.Array(reversed(path))
+
+    def __efun_call_strict__(self, fun: str, *args):
+        return getattr(self, "lpc_" + fun)(*args)
+
+# Layout of saved profiles (all values little-endian):
+#
+#   Header:        magic, version, number of strings, files and sections
+#   String table:  for each string its UTF-8 length and bytes,
+#                  padded to a multiple of 8 bytes at the end
+#   File table:    for each file the string index of its name, first line,
+#                  number of lines, total cost and time and the offset
+#                  of its line counters
+#   Section table: for each optional section its tag, offset and length,
+#                  unknown sections are ignored when loading
+#   Line counters: for each file four int64 arrays (cost, time,
+#                  indirect cost, indirect time) indexed by line - first line
+#   Sections:      PROFILE_SECTION_FUNCTIONS: for each function the string
+#                  indices of its program and function name.
+#                  PROFILE_SECTION_EDGES: the nodes of the calling-context
+#                  tree in preorder, each with the index of its parent node,
+#                  its function index and its counters.
+PROFILE_MAGIC = b"LDMUDPRF"
+PROFILE_VERSION = 1
+PROFILE_HEADER = struct.Struct("<8sIIII")
+PROFILE_STRING = struct.Struct("<I")
+PROFILE_FILE = struct.Struct("<IIIIqqQ")
+PROFILE_SECTION = struct.Struct("<IIQQ")
+PROFILE_SECTION_FUNCTIONS = 1
+PROFILE_SECTION_EDGES = 2
+PROFILE_FUNCTION = struct.Struct("<II")
+PROFILE_EDGE = struct.Struct("<IIIIqqqqq")
+PROFILE_NONE = 0xffffffff
+
+def _align(pos):
+    return (pos + 7) & ~7
+
 class profile_result:
     @dataclasses.dataclass
     class LineInfo:
@@ -21,6 +145,8 @@ class profile_result:
 
     def __init__(self):
         self.files = collections.defaultdict(profile_result.FileInfo)
+        self.mapped = {} # fname: (counters, first line) of a loaded profile, not yet read into lines.
+        self.tree = None # Root of the calling-context tree, if requested.
 
     def add_line_info(self, fname, line, ticks, time):
         info = self.files[fname]
@@ -34,14 +160,221 @@ class profile_result:
         info.lines[line].indirect_cost += ticks
         info.lines[line].indirect_time += time
 
+    def get_lines(self, fname):
+        """
+        Returns the line information for <fname>, reading it
+        from the saved profile if it was not accessed before.
+        """
+        info = self.files[fname]
+        mapped = self.mapped.pop(fname, None)
+        if mapped is not None:
+            counters, first_line = mapped
+            num_lines = len(counters) // 4
+            last_line = first_line + num_lines - 1
+            lines = info.lines
+            for line, cost, elapsed, indirect_cost, indirect_time in zip(
+                    range(first_line, last_line + 1),
+                    counters[0:num_lines],
+                    counters[num_lines:2*num_lines],
+                    counters[2*num_lines:3*num_lines],
+                    counters[3*num_lines:4*num_lines]):
+                if not (cost or elapsed or indirect_cost or indirect_time or line == first_line or line == last_line):
+                    continue
+                line_info = lines[line]
+                line_info.cost += cost
+                line_info.time += elapsed
+                line_info.indirect_cost += indirect_cost
+                line_info.indirect_time += indirect_time
+        return info.lines
+
+    def merge(self, other):
+        """
+        Adds the information from another profile_result.
+        """
+        for fname, other_info in other.files.items():
+            if fname not in self.files and fname in other.mapped:
+                # The saved counters can be shared until they are accessed.
+                self.files[fname] = profile_result.FileInfo(other_info.cost, other_info.time)
+                self.mapped[fname] = other.mapped[fname]
+                continue
+
+            info = self.files[fname]
+            info.cost += other_info.cost
+            info.time += other_info.time
+            lines = self.get_lines(fname)
+            for line, other_line_info in other.get_lines(fname).items():
+                line_info = lines[line]
+                line_info.cost += other_line_info.cost
+                line_info.time += other_line_info.time
+                line_info.indirect_cost += other_line_info.indirect_cost
+                line_info.indirect_time += other_line_info.indirect_time
+
+        if other.tree is not None:
+            if self.tree is None:
+                self.tree = profile_node(None, None, None, other.tree.line_number)
+            self.tree.merge(other.tree)
+
+    def save(self, path, tmp_path = None):
+        """
+        Writes the profile into the given file. The data is written
+        to <tmp_path> first (<path> with .tmp appended by default),
+        which is then renamed to <path>.
+        """
+        string_ids = {}
+        strings = bytearray()
+        def intern(name):
+            if name is None:
+                return PROFILE_NONE
+            idx = string_ids.get(name)
+            if idx is None:
+                idx = string_ids[name] = len(string_ids)
+                encoded = name.encode("utf-8")
+                strings.extend(PROFILE_STRING.pack(len(encoded)))
+                strings.extend(encoded)
+            return idx
+
+        fnames = sorted(self.files.keys())
+        fname_ids = [ intern(fname) for fname in fnames ]
+
+        tree_tables = []
+        if self.tree is not None:
+            function_ids = {}
+            node_ids = {}
+            functions = bytearray()
+            edges = bytearray()
+            for node in self.tree.walk():
+                key = (node.program_name, node.function_name,)
+                function_idx = function_ids.get(key)
+                if function_idx is None:
+                    function_idx = function_ids[key] = len(function_ids)
+                    functions += PROFILE_FUNCTION.pack(intern(node.program_name), intern(node.function_name))
+                node_ids[node] = len(node_ids)
+                parent_idx = PROFILE_NONE if node.parent is None else node_ids[node.parent]
+                edges += PROFILE_EDGE.pack(parent_idx, function_idx, node.line_number or 0, 0, node.calls, node.cost, node.time, node.exclusive_cost, node.exclusive_time)
+            tree_tables.append((PROFILE_SECTION_FUNCTIONS, functions,))
+            tree_tables.append((PROFILE_SECTION_EDGES, edges,))
+
+        pos = _align(PROFILE_HEADER.size + len(strings))
+        strings += bytes(pos - PROFILE_HEADER.size - len(strings))
+        pos += PROFILE_FILE.size * len(fnames) + PROFILE_SECTION.size * len(tree_tables)
+
+        file_table = bytearray()
+        counters = []
+        for idx, fname in enumerate(fnames):
+            info = self.files[fname]
+            lines = self.get_lines(fname)
+            if lines:
+                first_line = min(lines.keys())
+                num_lines = max(lines.keys()) - first_line + 1
+            else:
+                first_line = num_lines = 0
+
+            values = array.array('q', bytes(4 * 8 * num_lines))
+            for line, line_info in lines.items():
+                offset = line - first_line
+                values[offset] = line_info.cost
+                values[offset + num_lines] = line_info.time
+                values[offset + 2*num_lines] = line_info.indirect_cost
+                values[offset + 3*num_lines] = line_info.indirect_time
+            if sys.byteorder != 'little':
+                values.byteswap()
+
+            file_table += PROFILE_FILE.pack(fname_ids[idx], first_line, num_lines, 0, info.cost, info.time, pos)
+            counters.append(values)
+            pos += len(values) * 8
+
+        sections = []
+        for tag, table in tree_tables:
+            sections.append((tag, 0, pos, len(table),))
+            pos += len(table)
+
+        if tmp_path is None:
+            tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(PROFILE_HEADER.pack(PROFILE_MAGIC, PROFILE_VERSION, len(string_ids), len(fnames), len(sections)))
+            f.write(strings)
+            f.write(file_table)
+            for section in sections:
+                f.write(PROFILE_SECTION.pack(*section))
+            for values in counters:
+                values.tofile(f)
+            for tag, table in tree_tables:
+                f.write(table)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        """
+        Loads a saved profile. The file is memory-mapped and the line
+        counters of a file are only read when they are accessed.
+        """
+        with open(path, "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        (magic, version, num_strings, num_files, num_sections,) = PROFILE_HEADER.unpack_from(data, 0)
+        if magic != PROFILE_MAGIC or version != PROFILE_VERSION:
+            raise ValueError("Unsupported profile file format.")
+
+        pos = PROFILE_HEADER.size
+        strings = []
+        for _ in range(num_strings):
+            (length,) = PROFILE_STRING.unpack_from(data, pos)
+            pos += PROFILE_STRING.size
+            strings.append(str(data[pos:pos+length], "utf-8"))
+            pos += length
+        pos = _align(pos)
+
+        pr = profile_result()
+        for _ in range(num_files):
+            (name, first_line, num_lines, _, cost, time, offset,) = PROFILE_FILE.unpack_from(data, pos)
+            pos += PROFILE_FILE.size
+
+            fname = strings[name]
+            counters = data[offset:offset + 4 * 8 * num_lines]
+            if sys.byteorder == 'little':
+                counters = counters.cast('q')
+            else:
+                counters = array.array('q', counters)
+                counters.byteswap()
+
+            pr.files[fname] = profile_result.FileInfo(cost, time)
+            pr.mapped[fname] = (counters, first_line,)
+
+        sections = {}
+        for _ in range(num_sections):
+            (tag, _, offset, length,) = PROFILE_SECTION.unpack_from(data, pos)
+            pos += PROFILE_SECTION.size
+            sections[tag] = data[offset:offset+length]
+
+        if PROFILE_SECTION_FUNCTIONS in sections and PROFILE_SECTION_EDGES in sections:
+            def name(idx):
+                return None if idx == PROFILE_NONE else strings[idx]
+
+            functions = [ (name(program_idx), name(function_idx),) for (program_idx, function_idx,) in PROFILE_FUNCTION.iter_unpack(sections[PROFILE_SECTION_FUNCTIONS]) ]
+            nodes = []
+            for (parent_idx, function_idx, line_number, _, calls, cost, time, exclusive_cost, exclusive_time,) in PROFILE_EDGE.iter_unpack(sections[PROFILE_SECTION_EDGES]):
+                program_name, function_name = functions[function_idx]
+                if parent_idx == PROFILE_NONE:
+                    node = pr.tree = profile_node(None, program_name, function_name, line_number)
+                else:
+                    node = nodes[parent_idx].get_child(program_name, function_name, line_number)
+                node.calls = calls
+                node.cost = cost
+                node.time = time
+                node.exclusive_cost = exclusive_cost
+                node.exclusive_time = exclusive_time
+                nodes.append(node)
+
+        return pr
+
     def lpc_get_files(self):
         return ldmud.Array(sorted(self.files.keys()))
 
     def lpc_get_first_line(self, fname: str):
-        return min(self.files[fname].lines.keys())
+        return min(self.get_lines(fname).keys())
 
     def lpc_get_last_line(self, fname: str):
-        return max(self.files[fname].lines.keys())
+        return max(self.get_lines(fname).keys())
 
     def lpc_get_file_cost(self, fname: str):
         return self.files[fname].cost
@@ -50,16 +383,30 @@ class profile_result:
         return self.files[fname].time
 
     def lpc_get_line_cost(self, fname: str, line: int):
-        return self.files[fname].lines[line].cost
+        return self.get_lines(fname)[line].cost
 
     def lpc_get_line_time(self, fname: str, line: int):
-        return self.files[fname].lines[line].time
+        return self.get_lines(fname)[line].time
 
     def lpc_get_line_indirect_cost(self, fname: str, line: int):
-        return self.files[fname].lines[line].indirect_cost
+        return self.get_lines(fname)[line].indirect_cost
 
     def lpc_get_line_indirect_time(self, fname: str, line: int):
-        return self.files[fname].lines[line].indirect_time
+        return self.get_lines(fname)[line].indirect_time
+
+    def lpc_get_tree(self):
+        return self.tree
+
+    def lpc_get_top_paths(self, count: int):
+        if self.tree is None:
+            return ldmud.Array()
+        nodes = (node for node in self.tree.walk() if node.parent is not None)
+        return ldmud.Array(heapq.nlargest(count, nodes, key=lambda node: node.exclusive_cost))
+
+    def lpc_merge(self, other) -> None:
+        if not isinstance(other, profile_result):
+            raise TypeError("Bad arg 1 to merge(): expected profile_result.")
+        self.merge(other)
 
     def lpc_is_empty(self):
         return not self.files
@@ -67,6 +414,28 @@ class profile_result:
     def __efun_call_strict__(self, fun: str, *args):
         return getattr(self, "lpc_" + fun)(*args)
 
+def check_file_access(path: str, efun: str, write: bool) -> str:
+    """
+    Asks the master for permission to access <path> and returns
+    the file system path relative to the mudlib directory.
+    """
+    master = ldmud.get_master()
+    this_object = ldmud.efuns.this_object()
+    if master != this_object:
+        if write:
+            valid = master.functions.valid_write(path, ldmud.efuns.geteuid(this_object), efun, this_object)
+        else:
+            valid = master.functions.valid_read(path, ldmud.efuns.geteuid(this_object), efun, this_object)
+        if not valid:
+            raise PermissionError("Insufficient privileges for %s()" % (efun,))
+        if isinstance(valid, str):
+            path = valid
+
+    path = os.path.normpath("/" + path).lstrip("/")
+    if not path:
+        raise ValueError("Bad arg 1 to %s(): invalid file name." % (efun,))
+    return path
+
 def efun_profile_call(result: ldmud.Lvalue, fun: ldmud.Closure, *args) -> profile_result:
     """
     SYNOPSIS
@@ -116,67 +485,191 @@ def efun_profile_call(result: ldmud.Lvalue, fun: ldmud.Closure, *args) -> profil
                     Returns a value != 0, if there was no information
                     collected.
 
+                void merge(profile_result other)
+                    Adds the information from <other> to this result.
+
+                profile_node get_tree()
+                    Returns the root of the calling-context tree, if it was
+                    gathered by profile_call_tree(), otherwise 0.
+
+                profile_node* get_top_paths(int count)
+                    Returns the <count> nodes of the calling-context tree
+                    with the highest exclusive costs. Use get_path() to
+                    get the whole call path of a node.
+
     SEE ALSO
-            trace_call
+            profile_call_tree, profile_save, profile_load, trace_call
     """
 
-    @dataclasses.dataclass
-    class PreviousLine:
-        fname: str = None
-        line_number: int = None
-        ns: int = None
-        eval_cost: int = None
 
     if not isinstance(result, ldmud.Lvalue):
         raise TypeError("Bad arg 1 to profile_call(): expected mixed &.")
 
-    pr = profile_result()
+    return profile(result, fun, args)
+
+profile_call_tree_options = ldmud.register_struct("profile_call_tree_options", None, (
+    ('max_depth', int,),
+    ('fold_recursion', int,),
+))
+
+def efun_profile_call_tree(opts: profile_call_tree_options, result: ldmud.Lvalue, fun: ldmud.Closure, *args) -> profile_result:
+    """
+    SYNOPSIS
+            profile_result profile_call_tree(struct profile_call_tree_options opts, mixed& result, closure fun, mixed arg, ...)
+
+    DESCRIPTION
+            Calls <fun> with the given arguments and stores the result in
+            <result>, which must be passed by reference.
+
+            Gathers the same profiling information as profile_call() and
+            additionally builds a calling-context tree. Each node in the
+            tree represents a function called from a specific call path,
+            i.e. the same function called from different places will have
+            separate nodes.
+
+            The following options can be given:
+
+                int max_depth
+                    Don't create nodes beyond that depth in the tree,
+                    deeper calls are accounted to their ancestor at
+                    that depth.
+
+                int fold_recursion
+                    When a function is called recursively, account the call
+                    to the node of the outer call, instead of creating a
+                    new node below it.
+
+            The root of the tree is returned by the get_tree() function of
+            the result. It represents the call of <fun> itself. A node
+            provides the following functions:
+
+                string get_program_name()
+                    Returns the program name of the function.
+
+                string get_function_name()
+                    Returns the function name.
+
+                int get_line_number()
+                    Returns the line number of the call in the calling
+                    function.
+
+                int get_calls()
+                    Returns the number of calls.
+
+                int get_cost()
+                    Returns the accumulated costs including called
+                    functions.
+
+                int get_exclusive_cost()
+                    Returns the accumulated costs without called functions.
+
+                int get_time()
+                    Returns the accumulated durations in nanoseconds
+                    including called functions.
+
+                int get_exclusive_time()
+                    Returns the accumulated durations in nanoseconds
+                    without called functions.
+
+                profile_node get_parent()
+                    Returns the calling node, 0 for the root.
+
+                profile_node* get_children()
+                    Returns the called nodes sorted by decreasing costs.
+
+                profile_node* get_path()
+                    Returns the nodes from the top of the tree (excluding
+                    the root) down to this node.
+
+    SEE ALSO
+            profile_call, trace_call
+    """
+
+    if not isinstance(result, ldmud.Lvalue):
+        raise TypeError("Bad arg 2 to profile_call_tree(): expected mixed &.")
+
+    if not opts:
+        opts = profile_call_tree_options()
+
+    return profile(result, fun, args, build_tree = True, tree_max_depth = opts.members.max_depth.value, fold_recursion = opts.members.fold_recursion.value != 0)
+
+# Number of records profile() buffers before aggregating them.
+PROFILE_BUFFER_SIZE = 1024
+
+def profile(result, fun, args, build_tree = False, tree_max_depth = 0, fold_recursion = False):
+    """
+    Calls <fun> with <args>, assigns the result to <result>
+    and returns the gathered profile_result.
+
+    While executing the hook only records the raw information
+    for each instruction into a buffer. The records are aggregated
+    whenever the buffer is full and at the end of the call.
+    """
+
     start_depth = len(ldmud.call_stack) - 1
-    stack = [None] * start_depth
-    last = PreviousLine()
-    last.eval_cost = ldmud.call_stack[-1].eval_cost
-    last.ns = time_ns()
+    start_eval_cost = ldmud.call_stack[-1].eval_cost
+    start_ns = time_ns()
+    depth = start_depth
+
+    builder = ProfileBuilder(start_depth, start_eval_cost, start_ns, build_tree, tree_max_depth, fold_recursion)
+
+    # One record per instruction, the last one for the end of the call.
+    steps = records.RecordBuffer(('line_number', 'eval_cost', 'ns',))
+    file_names = []
+    # For each change of the stack depth: (index of the instruction, new depth,
+    # information about the call frames entered)
+    depth_changes = []
+    # Time spent aggregating full buffers, it is not accounted to the instructions.
+    excluded_ns = 0
+
+    append_file_name = file_names.append
+    append_line_number = steps.line_number.append
+    append_eval_cost = steps.eval_cost.append
+    append_ns = steps.ns.append
+
+    def record_depth_change(cur_depth):
+        nonlocal depth
+
+        entered = []
+        while cur_depth > depth:
+            new_frame = ldmud.call_stack[depth]
+            callee = ldmud.call_stack[depth + 1]
+            entered.append((new_frame.type, new_frame.file_name, new_frame.line_number, new_frame.eval_cost, callee.type, callee.program_name, callee.name,))
+            depth += 1
+        depth = cur_depth
+        depth_changes.append((len(file_names), cur_depth, entered,))
+
+    def flush():
+        nonlocal excluded_ns
+
+        flush_ns = time_ns()
+        builder.add(file_names, steps, depth_changes, False)
+        file_names.clear()
+        steps.clear()
+        depth_changes.clear()
+        excluded_ns += time_ns() - flush_ns
 
     def hook(ob, instr):
-        nonlocal last, stack
-
-        cur_frame = ldmud.call_stack[-1]
-        cur_fname = cur_frame.file_name
-        cur_ns = time_ns()
-        cur_depth = len(ldmud.call_stack) - 1 # Don't use the current frame.
+        call_stack = ldmud.call_stack
+        cur_frame = call_stack[-1]
+        cur_ns = time_ns() - excluded_ns
+        cur_depth = len(call_stack) - 1 # Don't use the current frame.
 
         # Safeguard
         if cur_depth < start_depth:
             ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
 
-        if last.fname and last.line_number:
-            pr.add_line_info(last.fname, last.line_number, max(1, cur_frame.eval_cost - last.eval_cost), cur_ns - last.ns)
-            last.ns = cur_ns
-            last.eval_cost = cur_frame.eval_cost
+        # Don't do stack cleanup at the end, we will only get the profile_call() call.
+        if cur_depth != depth and instr is not None:
+            record_depth_change(cur_depth)
 
-        if instr is None: # Don't do stack cleanup at the end, we will only get the profile_call() call.
-            return
+        append_file_name(cur_frame.file_name)
+        append_line_number(cur_frame.line_number or 0)
+        append_eval_cost(cur_frame.eval_cost)
+        append_ns(cur_ns)
 
-        if cur_fname:
-            last.fname = cur_fname
-            last.line_number = cur_frame.line_number
-
-        while cur_depth > len(stack):
-            new_frame = ldmud.call_stack[len(stack)]
-            if new_frame.type == ldmud.CALL_FRAME_TYPE_LFUN:
-                prev = PreviousLine()
-                prev.fname = new_frame.file_name
-                prev.line_number = new_frame.line_number
-                prev.ns = cur_ns
-                prev.eval_cost = new_frame.eval_cost
-                stack.append(prev)
-            else:
-                stack.append(None)
-
-        while cur_depth < len(stack):
-            prev = stack.pop()
-            if prev is not None and prev.fname and prev.line_number:
-                pr.add_line_indirect_info(prev.fname, prev.line_number, max(1, cur_frame.eval_cost - prev.eval_cost), cur_ns - prev.ns)
+        if len(file_names) >= PROFILE_BUFFER_SIZE:
+            flush()
 
     ldmud.register_hook(ldmud.BEFORE_INSTRUCTION, hook)
     try:
@@ -185,12 +678,215 @@ def efun_profile_call(result: ldmud.Lvalue, fun: ldmud.Closure, *args) -> profil
         ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
     hook(None, None) # Process last instruction
 
-    return pr
+    builder.add(file_names, steps, depth_changes, True)
+    return builder.finish()
+
+class ProfileBuilder:
+    """
+    Aggregates the records of profile() into a profile_result.
+
+    The records are passed in chunks, the state between them
+    (call stack, current line and tree node) is kept here.
+    """
+    def __init__(self, start_depth, start_eval_cost, start_ns, build_tree, tree_max_depth, fold_recursion):
+        self.pr = profile_result()
+        self.line_info = collections.defaultdict(lambda: [0, 0]) # (file, line): [cost, time]
+        self.indirect_info = collections.defaultdict(lambda: [0, 0])
+        self.start_depth = start_depth
+        self.stack = [None] * start_depth # For each call frame: (file, line, ns, eval_cost) of the call
+        self.last_file = None
+        self.last_line = None
+        self.last_eval_cost = start_eval_cost
+        self.last_ns = start_ns
+        # Sum of the ticks and time of all intervals so far. The costs of the
+        # tree nodes are taken from these, so a node's cost is the sum of its
+        # exclusive cost and the costs of its children.
+        self.total_cost = 0
+        self.total_time = 0
+        self.tree_max_depth = tree_max_depth
+        self.fold_recursion = fold_recursion
+
+        if build_tree:
+            self.pr.tree = self.last_node = profile_node(None, None, None, ldmud.call_stack[-1].line_number)
+            self.pr.tree.calls = 1
+            # For each call below start_depth: (node, total_time, total_cost, whether the node was entered by this call)
+            self.nodes = [(self.pr.tree, 0, 0, True,)]
+        else:
+            self.last_node = None
+            self.nodes = None
+
+    def enter_node(self, callee_type, program_name, function_name, line_number, elapsed, cost):
+        nodes = self.nodes
+        parent = nodes[-1][0]
+        if (self.tree_max_depth and len(nodes) > self.tree_max_depth) or callee_type not in (ldmud.CALL_FRAME_TYPE_LFUN, ldmud.CALL_FRAME_TYPE_LAMBDA):
+            nodes.append((parent, elapsed, cost, False,))
+            return
+
+        if self.fold_recursion:
+            ancestor = parent
+            while ancestor.parent is not None:
+                if ancestor.program_name == program_name and ancestor.function_name == function_name:
+                    ancestor.calls += 1
+                    nodes.append((ancestor, elapsed, cost, False,))
+                    return
+                ancestor = ancestor.parent
+
+        node = parent.get_child(program_name, function_name, line_number)
+        node.calls += 1
+        # With folded recursion the node might be entered already,
+        # its cost and time are then counted by the outer call.
+        entered = not self.fold_recursion or not any(active is node for (active, _, _, _,) in nodes)
+        nodes.append((node, elapsed, cost, entered,))
+
+    def leave_node(self, elapsed, cost):
+        (node, start_elapsed, start_cost, entered,) = self.nodes.pop()
+        if entered:
+            node.cost += cost - start_cost
+            node.time += elapsed - start_elapsed
+
+    def add(self, file_names, steps, depth_changes, last):
+        """
+        Aggregates a chunk of records. The indices in <depth_changes>
+        are relative to the chunk. If <last> is true, the last record
+        marks the end of the call.
+        """
+        line_info = self.line_info
+        indirect_info = self.indirect_info
+        stack = self.stack
+        nodes = self.nodes
+        start_depth = self.start_depth
+        last_file = self.last_file
+        last_line = self.last_line
+        last_eval_cost = self.last_eval_cost
+        last_ns = self.last_ns
+        last_node = self.last_node
+        total_cost = self.total_cost
+        total_time = self.total_time
+
+        last_idx = len(file_names) - 1 if last else -1
+        changes = iter(depth_changes)
+        next_change = next(changes, None)
+        for idx, (file_name, (line_number, eval_cost, ns,),) in enumerate(zip(file_names, steps.records())):
+            if last_file and last_line:
+                ticks = max(1, eval_cost - last_eval_cost)
+                elapsed = ns - last_ns
+                info = line_info[(last_file, last_line,)]
+                info[0] += ticks
+                info[1] += elapsed
+                total_cost += ticks
+                total_time += elapsed
+                if nodes is not None:
+                    last_node.exclusive_cost += ticks
+                    last_node.exclusive_time += elapsed
+                last_ns = ns
+                last_eval_cost = eval_cost
+
+            if idx == last_idx:
+                break
+
+            if file_name:
+                last_file = file_name
+                last_line = line_number
+
+            if next_change is None or next_change[0] != idx:
+                continue
+
+            (_, depth, entered,) = next_change
+            next_change = next(changes, None)
+
+            for (frame_type, call_file, call_line, call_eval_cost, callee_type, callee_program_name, callee_function_name,) in entered:
+                if nodes is not None and len(stack) >= start_depth:
+                    self.enter_node(callee_type, callee_program_name, callee_function_name, call_line, total_time, total_cost)
+                if frame_type == ldmud.CALL_FRAME_TYPE_LFUN:
+                    stack.append((call_file, call_line, ns, call_eval_cost,))
+                else:
+                    stack.append(None)
+
+            while depth < len(stack):
+                prev = stack.pop()
+                if prev is not None and prev[0] and prev[1]:
+                    info = indirect_info[(prev[0], prev[1],)]
+                    info[0] += max(1, eval_cost - prev[3])
+                    info[1] += ns - prev[2]
+                if nodes is not None and len(stack) >= start_depth:
+                    self.leave_node(total_time, total_cost)
+
+            if nodes is not None:
+                last_node = nodes[-1][0]
+
+        self.last_file = last_file
+        self.last_line = last_line
+        self.last_eval_cost = last_eval_cost
+        self.last_ns = last_ns
+        self.last_node = last_node
+        self.total_cost = total_cost
+        self.total_time = total_time
+
+    def finish(self):
+        """
+        Returns the profile_result of all records added.
+        """
+        pr = self.pr
+        for (file_name, line_number,), (cost, elapsed,) in self.line_info.items():
+            pr.add_line_info(file_name, line_number, cost, elapsed)
+        for (file_name, line_number,), (cost, elapsed,) in self.indirect_info.items():
+            pr.add_line_indirect_info(file_name, line_number, cost, elapsed)
+
+        if self.nodes is not None:
+            while len(self.nodes) > 1:
+                self.leave_node(self.total_time, self.total_cost)
+            pr.tree.cost = self.total_cost
+            pr.tree.time = self.total_time
+
+        return pr
+
+def efun_profile_save(pr: profile_result, fname: str) -> None:
+    """
+    SYNOPSIS
+            void profile_save(profile_result pr, string filename)
+
+    DESCRIPTION
+            Saves the profiling information in <pr> into the file
+            <filename> using a compact binary format.
+
+            The file is written under the name <filename>.tmp first and
+            then renamed to <filename>. The master is asked for
+            permission for both names with valid_write().
+
+    SEE ALSO
+            profile_load, profile_call
+    """
+
+    pr.save(check_file_access(fname, "profile_save", True), check_file_access(fname + ".tmp", "profile_save", True))
+
+def efun_profile_load(fname: str) -> profile_result:
+    """
+    SYNOPSIS
+            profile_result profile_load(string filename)
+
+    DESCRIPTION
+            Loads profiling information that was saved with profile_save().
+
+            The file is memory-mapped and the line information is only
+            read when it is accessed, so even large profiles load
+            instantly. The result can be merged with other results
+            using its merge() function.
+
+            The master is asked for permission with valid_read().
+
+    SEE ALSO
+            profile_save, profile_call
+    """
 
+    return profile_result.load(check_file_access(fname, "profile_load", False))
 
 def register():
     """
     Register efuns and types.
     """
     ldmud.register_type("profile_result", profile_result)
+    ldmud.register_type("profile_node", profile_node)
     ldmud.register_efun("profile_call", efun_profile_call)
+    ldmud.register_efun("profile_call_tree", efun_profile_call_tree)
+    ldmud.register_efun("profile_save", efun_profile_save)
+    ldmud.register_efun("profile_load", efun_profile_load)
@@ -0,0 +1,35 @@
+import array
+
+class RecordBuffer:
+    """
+    A buffer of fixed-size integer records.
+
+    Each field is stored in its own typed array, available as an
+    attribute named after the field. To keep the hooks cheap they
+    bind the append methods of the columns once and call them
+    directly for each record.
+    """
+    def __init__(self, fields):
+        self.columns = tuple(array.array('q') for _ in fields)
+        for name, column in zip(fields, self.columns):
+            setattr(self, name, column)
+
+    def replace_last(self, *values):
+        for column, value in zip(self.columns, values):
+            column[-1] = value
+
+    def clear(self):
+        """
+        Removes all records.
+        """
+        for column in self.columns:
+            del column[:]
+
+    def records(self):
+        """
+        Returns an iterator over all records as tuples.
+        """
+        return zip(*self.columns)
+
+    def __len__(self):
+        return len(self.columns[0])
@@ -1,5 +1,5 @@
-import ldmud, time
-from . import formatting
+import ldmud, collections, gc, itertools, math, sys, time
+from . import formatting, records
 
 time_ns = getattr(time, 'time_ns', None)
 if not time_ns:
@@ -23,6 +23,222 @@ class Step:
         self.variables_dict.setdefault(name, []).append(len(self.variables))
         self.variables.append((name, value,))
 
+    def memory_usage(self):
+        return STEP_MEMORY_USAGE + sum(VARIABLE_MEMORY_USAGE + sys.getsizeof(value) for name, value in self.variables)
+
+# Integer fields of the records written while tracing. They are arranged
+# into the call hierarchy after the call. The object, program and file
+# name of each record are kept in separate lists.
+TRACE_RECORD_FIELDS = ('depth', 'line_number', 'eval_cost', 'eval_time', 'variables',)
+
+# The frame information of a record, used to create a Step.
+RecordedFrame = collections.namedtuple('RecordedFrame', ('object', 'program_name', 'file_name', 'line_number', 'eval_cost',))
+
+# Approximate memory usage in bytes of the trace data structures
+# (including the slot in their container).
+_sample = Step(RecordedFrame(None, None, None, 0, 0), 0)
+STEP_MEMORY_USAGE = sum(sys.getsizeof(x) for x in (_sample, _sample.__dict__, _sample.calls, _sample.variables_dict, _sample.variables,)) + 8
+VARIABLE_MEMORY_USAGE = sys.getsizeof(('', '',)) + sys.getsizeof([0]) + 2*8
+del _sample
+
+def join_function(granularity):
+    """
+    Returns a function that determines whether two subsequent
+    steps can be aggregated into one for the given granularity.
+    """
+    if granularity == 2: # Function
+        def allow_join(prev, cur):
+            return True
+    elif granularity == 1: # By Line
+        def allow_join(prev, cur):
+            return prev.file_name == cur.file_name and prev.line_number == cur.line_number
+    else:
+        def allow_join(prev, cur):
+            return False
+    return allow_join
+
+class MemoryBudget:
+    """
+    Keeps track of the approximate memory usage of a trace and
+    degrades the recording when the usage approaches the budget.
+    """
+
+    # Fraction of the budget at which each degradation is applied.
+    LEVELS = (
+        (0.7, 'variables',),
+        (0.8, 'line',),
+        (0.9, 'function',),
+        (1.0, 'stop',),
+    )
+
+    def __init__(self, budget, granularity, capture_variables, degradations):
+        self.budget = budget
+        self.limit = budget or math.inf
+        self.usage = 0
+        self.level = 0
+        self.threshold = self.LEVELS[0][0] * budget if budget else math.inf
+        self.granularity = granularity
+        self.capture_variables = capture_variables
+        self.stopped = False
+        self.degradations = degradations
+
+    def charge(self, size):
+        self.usage += size
+        if self.usage >= self.threshold:
+            self.apply_levels()
+
+    def release(self, size):
+        self.usage -= size
+
+    def fits(self, size):
+        return self.usage + size <= self.limit
+
+    def reserve(self, size):
+        """
+        Checks whether <size> more bytes fit into the budget,
+        stops the recording otherwise.
+        """
+        if self.stopped:
+            return False
+        if not self.fits(size):
+            self.degrade('stop')
+            return False
+        return True
+
+    def apply_levels(self):
+        levels = self.LEVELS
+        while self.level < len(levels) and self.usage >= levels[self.level][0] * self.budget:
+            self.degrade(levels[self.level][1])
+            self.level += 1
+        self.threshold = levels[self.level][0] * self.budget if self.level < len(levels) else math.inf
+
+    def degrade(self, degradation):
+        if degradation == 'variables':
+            if not self.capture_variables:
+                return
+            self.capture_variables = False
+        elif degradation == 'line':
+            if self.granularity >= 1:
+                return
+            self.granularity = 1
+        elif degradation == 'function':
+            if self.granularity >= 2:
+                return
+            self.granularity = 2
+        else:
+            if self.stopped:
+                return
+            self.stopped = True
+
+        if degradation not in self.degradations:
+            self.degradations.append(degradation)
+
+class TraceBuilder:
+    """
+    Arranges recorded steps into the call hierarchy of a trace.
+
+    Without a memory budget the records are the raw instructions,
+    they are aggregated to the given granularity here. With a budget
+    this was already done while recording, and the granularity is 0.
+    """
+    def __init__(self, tr, start_depth, granularity, format_variable):
+        self.stack = [ tr.steps ]
+        self.start_depth = start_depth
+        self.elapsed = 0 # Time since the start of the last added step.
+        self.allow_join = join_function(granularity)
+        self.format_variable = format_variable
+
+    def add(self, frame, depth, elapsed, variables = None):
+        """
+        Adds a step for <frame> at the given stack depth, <elapsed>
+        nanoseconds after the previous record. <variables> is a tuple
+        of (name, value) pairs to store with the step. If a
+        <format_variable> function was given, the values are
+        formatted with it first.
+        """
+        stack = self.stack
+        self.elapsed += elapsed
+        step = Step(frame, self.elapsed)
+
+        parent_idx = depth - self.start_depth
+        if len(stack) > parent_idx + 1:
+            del stack[parent_idx+1:]
+        elif len(stack) < parent_idx + 1:
+            stack.extend(None for _ in range(len(stack), parent_idx + 1))
+        while stack[parent_idx] is None:
+            parent_idx -= 1
+
+        stack_entry = stack[parent_idx]
+        if stack_entry and self.allow_join(stack_entry[-1], step) and not stack_entry[-1].calls:
+            stack_entry[-1] = step
+        else:
+            stack_entry.append(step)
+            self.elapsed = 0
+        stack.append(step.calls)
+
+        if variables is not None:
+            format_variable = self.format_variable
+            for name, value in variables:
+                if format_variable is not None:
+                    value = format_variable(value)
+                step.add_variable(name, value)
+
+class JoinedStep:
+    """
+    A view of subsequent steps that are aggregated into one.
+
+    It provides the information of the last of these steps, <eval_time>
+    is the sum of the times of all of them. The called steps are
+    aggregated only when they are accessed.
+    """
+    def __init__(self, step, eval_time, allow_join):
+        self.step = step
+        self.eval_time = eval_time
+        self.allow_join = allow_join
+        self.joined_calls = None
+
+    @property
+    def calls(self):
+        if self.joined_calls is None:
+            self.joined_calls = JoinedSteps(self.step.calls, self.allow_join)
+        return self.joined_calls
+
+    def __getattr__(self, name):
+        return getattr(self.step, name)
+
+class JoinedSteps:
+    """
+    A view of a list of steps aggregated to a coarser granularity.
+    The aggregation is done when the list is accessed first.
+    """
+    def __init__(self, steps, allow_join):
+        self.steps = steps
+        self.allow_join = allow_join
+        self.joined = None
+
+    def get_joined(self):
+        if self.joined is None:
+            steps = self.steps
+            joined = []
+            eval_time = 0
+            for idx in range(1, len(steps) + 1):
+                step = steps[idx-1]
+                eval_time += step.eval_time
+                if idx == len(steps) or step.calls or not self.allow_join(step, steps[idx]):
+                    joined.append(JoinedStep(step, eval_time, self.allow_join))
+                    eval_time = 0
+            self.joined = joined
+        return self.joined
+
+    def __bool__(self):
+        return bool(self.steps)
+
+    def __len__(self):
+        return len(self.get_joined())
+
+    def __getitem__(self, idx):
+        return self.get_joined()[idx]
+
 class trace_cursor:
     def __init__(self, steps, pos):
         self.stack = []
@@ -99,6 +315,11 @@ class trace_cursor:
 class trace_result:
     def __init__(self):
         self.steps = []
+        self.granularity = 0
+        self.memory_usage = None # Determined on request without a memory budget.
+        self.degradations = []
+        self.views = {} # granularity: trace_result
+        self.source = None # The trace this is a view of.
 
     def lpc_begin(self) -> trace_cursor:
         if not self.steps:
@@ -110,6 +331,39 @@ class trace_result:
             return None
         return trace_cursor(self.steps, len(self.steps)-1)
 
+    def lpc_get_memory_usage(self) -> int:
+        if self.source is not None:
+            return self.source.lpc_get_memory_usage()
+        if self.memory_usage is None:
+            usage = 0
+            pending = [self.steps]
+            while pending:
+                for step in pending.pop():
+                    usage += step.memory_usage()
+                    pending.append(step.calls)
+            self.memory_usage = usage
+        return self.memory_usage
+
+    def lpc_get_degradations(self) -> ldmud.Array[ldmud.String]:
+        return ldmud.Array(self.degradations)
+
+    def lpc_get_view(self, granularity: int) -> "trace_result":
+        if granularity not in (0, 1, 2):
+            raise ValueError("Bad arg 1 to get_view(): expected granularity 0, 1 or 2.")
+        if granularity <= self.granularity:
+            return self
+
+        view = self.views.get(granularity)
+        if view is None:
+            view = trace_result()
+            view.steps = JoinedSteps(self.steps, join_function(granularity))
+            view.granularity = granularity
+            view.degradations = self.degradations
+            view.views = self.views
+            view.source = self if self.source is None else self.source
+            self.views[granularity] = view
+        return view
+
     def __efun_call_strict__(self, fun: str, *args):
         return getattr(self, "lpc_" + fun)(*args)
 
@@ -121,6 +375,12 @@ trace_call_options = ldmud.register_struct("trace_call_options", None, (
     ('capture_local_variables', int,),
     ('variable_format_depth', int,),
     ('variable_format_compact', int,),
+    ('capture_variables', ldmud.Mapping,),
+    ('variable_filter', ldmud.Closure,),
+    ('max_variables', int,),
+    ('keep_min_time', int,),
+    ('keep_min_eval_cost', int,),
+    ('memory_budget', int,),
 ))
 
 def efun_trace_call(opts: trace_call_options, result: ldmud.Lvalue, fun: ldmud.Closure, *args) -> trace_result:
@@ -169,6 +429,52 @@ def efun_trace_call(opts: trace_call_options, result: ldmud.Lvalue, fun: ldmud.C
                 int variable_format_compact
                     Whether to use compact format.
 
+                mapping capture_variables
+                    A 0-width mapping containing the names of the local
+                    variables to capture. An empty mapping captures no
+                    variables at all. Implies <capture_local_variables>.
+
+                closure variable_filter
+                    A closure that is called with the name of a local
+                    variable and shall return a value != 0 if that variable
+                    is to be captured. The result is remembered, so the
+                    closure is only called once per variable name. The
+                    closure is not traced and its evaluation cost and
+                    time are not accounted to the traced steps.
+                    Implies <capture_local_variables>.
+
+                int max_variables
+                    The maximum number of variables to capture per step.
+                    Variables that are not selected by <capture_variables>
+                    or <variable_filter> don't count towards that limit.
+
+                int keep_min_time
+                int keep_min_eval_cost
+                    When any of these is given, the trace is only kept if
+                    the call took at least <keep_min_time> nanoseconds or
+                    at least <keep_min_eval_cost> ticks. Otherwise 0 is
+                    returned. Unless a <memory_budget> is given, captured
+                    variables are only formatted when the trace is kept,
+                    so arrays, mappings and structs show their state at
+                    the end of the call.
+
+                int memory_budget
+                    The maximum amount of memory in bytes the trace may
+                    approximately use. When the trace approaches this
+                    budget it degrades the recording in the following
+                    steps: At 70% of the budget it stops capturing
+                    variables, at 80% it aggregates by line, at 90% by
+                    function call, and when the budget is reached it
+                    stops recording. With a budget, captured variables
+                    are always formatted while recording (even when
+                    <keep_min_time> or <keep_min_eval_cost> are given),
+                    so their size is accounted for. Also the steps are
+                    aggregated to the granularity while recording, so
+                    the budget applies to the resulting trace. Without
+                    a budget the instructions are only recorded during
+                    the call and aggregated afterwards, which keeps the
+                    overhead during the call lower.
+
             This function raises a privilege violation("trace_call", object, opts, fun).
             The master can change the options when checking privileges.
 
@@ -183,6 +489,25 @@ def efun_trace_call(opts: trace_call_options, result: ldmud.Lvalue, fun: ldmud.C
                     Returns a cursor that represents the state at the end
                     of the execution.
 
+                int get_memory_usage()
+                    Returns the approximate memory usage of the trace
+                    in bytes.
+
+                string* get_degradations()
+                    Returns the degradations applied due to the memory
+                    budget in the order they happened. Possible entries
+                    are "variables", "line", "function" and "stop".
+
+                trace_result get_view(int granularity)
+                    Returns the trace aggregated to a coarser granularity
+                    (1 for lines, 2 for function calls). The view shares
+                    the recorded steps and aggregates them only when they
+                    are visited. The time of an aggregated step is the sum
+                    of the times of the steps it comprises. If the trace
+                    was already recorded with that or a coarser granularity,
+                    the trace itself is returned. Other values than 0, 1
+                    and 2 raise an error.
+
             A cursor object provides the following functions:
 
                 void step_into()
@@ -251,14 +576,73 @@ def efun_trace_call(opts: trace_call_options, result: ldmud.Lvalue, fun: ldmud.C
     exclude = opts.members.exclude.value
     include = opts.members.only.value
 
-    if opts.members.capture_local_variables.value:
+    capture_variables = opts.members.capture_variables.value
+    variable_filter = opts.members.variable_filter.value
+    max_variables = opts.members.max_variables.value
+
+    if opts.members.capture_local_variables.value or capture_variables is not None or variable_filter:
         formatter = formatting.LDMudFormatter(max_depth = opts.members.variable_format_depth.value, compact = opts.members.variable_format_compact.value != 0)
     else:
         formatter = None
 
+    # Evaluation cost and time spent in the variable filter,
+    # they are not accounted to the traced steps.
+    excluded_eval_cost = 0
+    excluded_ns = 0
+
+    def call_variable_filter(name):
+        """
+        Calls <variable_filter> with the tracing hook unregistered,
+        so its frames are not traced.
+        """
+        nonlocal excluded_eval_cost, excluded_ns
+        ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
+        eval_cost = ldmud.call_stack[-1].eval_cost
+        ns = time_ns()
+        try:
+            return bool(variable_filter(name))
+        finally:
+            excluded_ns += time_ns() - ns
+            excluded_eval_cost += ldmud.call_stack[-1].eval_cost - eval_cost
+            ldmud.register_hook(ldmud.BEFORE_INSTRUCTION, hook)
+
+    if capture_variables is not None or variable_filter:
+        selected_names = {}
+        def select_variable(name):
+            selected = selected_names.get(name)
+            if selected is None:
+                selected = capture_variables is None or name in capture_variables
+                if selected and variable_filter:
+                    # Don't ask again while the filter is running.
+                    selected_names[name] = False
+                    selected = call_variable_filter(name)
+                selected_names[name] = selected
+            return selected
+    else:
+        select_variable = None
+
+    def frame_variables(frame):
+        """
+        Returns the (name, value) pairs of the variables to capture.
+        Variables are skipped before their value is even retrieved.
+        """
+        variables = frame.variables.__dict__.items()
+        if select_variable is not None:
+            variables = ((name, var,) for name, var in variables if select_variable(name))
+        if max_variables > 0:
+            variables = itertools.islice(variables, max_variables)
+        return ((name, var.value,) for name, var in variables)
+
+    keep_min_time = opts.members.keep_min_time.value
+    keep_min_eval_cost = opts.members.keep_min_eval_cost.value
+    memory_budget = opts.members.memory_budget.value
+
+    if granularity not in (1, 2):
+        granularity = 0
+
     tr = trace_result()
+    tr.granularity = granularity
     start_depth = len(ldmud.call_stack) + 1
-    stack = [ tr.steps ]
 
     if not exclude and include is not None:
         def allow_frame(frame):
@@ -280,22 +664,124 @@ def efun_trace_call(opts: trace_call_options, result: ldmud.Lvalue, fun: ldmud.C
                 return False
             return True
 
-    if granularity == 2: # Function
-        def allow_join(prev, cur):
-            return True
-    elif granularity == 1: # By Line
-        def allow_join(prev, cur):
-            return prev.file_name == cur.file_name and prev.line_number == cur.line_number
-    else:
-        def allow_join(prev, cur):
-            return False
+    # When the trace might be thrown away, variables are formatted only
+    # when it is kept. Until then only references to the values are held.
+    # The size of the referenced values is unknown, so with a memory budget
+    # they are always formatted right away.
+    defer_formatting = (keep_min_time > 0 or keep_min_eval_cost > 0) and not memory_budget
+
+    steps = records.RecordBuffer(TRACE_RECORD_FIELDS)
+    objects = []
+    program_names = []
+    file_names = []
+    variables = [] # Captured (name, value) pairs, indexed by the steps.
+    memory = MemoryBudget(memory_budget, granularity, formatter is not None, tr.degradations)
+
+    append_depth = steps.depth.append
+    append_object = objects.append
+    append_program_name = program_names.append
+    append_file_name = file_names.append
+    append_line_number = steps.line_number.append
+    append_eval_cost = steps.eval_cost.append
+    append_eval_time = steps.eval_time.append
+    append_variables = steps.variables.append
+
+    start_eval_cost = ldmud.call_stack[-1].eval_cost
+    start_ns = time_ns()
+    last_ns = start_ns # Start of the last record.
+    last_size = 0 # Memory usage of the last step.
+
+    # The levels (depth - start_depth) of the lists the TraceBuilder
+    # will have on its stack, and the level of the list of the last step.
+    levels = [0]
+    last_depth = 0
+    last_level = -1
+
+    def capture(cur_frame):
+        if defer_formatting:
+            return tuple(frame_variables(cur_frame))
+        else:
+            return tuple((name, formatter.format(value),) for name, value in frame_variables(cur_frame))
+
+    def record_step(cur_frame, cur_depth, cur_ns, eval_cost):
+        """
+        Records a step while keeping the memory budget. Subsequent steps
+        in the same list (and same line for line granularity) are
+        aggregated into one already here, so the budget sees the size
+        of the resulting trace.
+        """
+        nonlocal last_ns, last_size, last_depth, last_level
+
+        file_name = cur_frame.file_name
+        line_number = cur_frame.line_number or 0
+        size = STEP_MEMORY_USAGE
+
+        if memory.capture_variables:
+            captured = capture(cur_frame)
+            size += sum(VARIABLE_MEMORY_USAGE + sys.getsizeof(value) for name, value in captured)
+        else:
+            captured = None
+
+        if cur_depth == last_depth:
+            level = last_level
+        else:
+            level = cur_depth - start_depth
+            while levels[-1] > level:
+                levels.pop()
+            levels.append(level + 1)
+            level = levels[-2]
+
+        cur_granularity = memory.granularity
+        if cur_granularity and level == last_level and (cur_granularity == 2 or (file_names[-1] == file_name and steps.line_number[-1] == line_number)):
+            if not memory.reserve(size - last_size):
+                ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
+                return
+            memory.release(last_size)
+            # The step replaces the last one, so does its slot for the variables.
+            variables_idx = steps.variables[-1]
+            if variables_idx >= 0:
+                variables[variables_idx] = captured
+                if captured is None:
+                    variables_idx = -1
+            elif captured is not None:
+                variables_idx = len(variables)
+                variables.append(captured)
+            objects[-1] = cur_frame.object
+            program_names[-1] = cur_frame.program_name
+            file_names[-1] = file_name
+            steps.replace_last(cur_depth, line_number, eval_cost, cur_ns - last_ns, variables_idx)
+        elif memory.reserve(size):
+            if captured is not None:
+                variables_idx = len(variables)
+                variables.append(captured)
+            else:
+                variables_idx = -1
+            append_depth(cur_depth)
+            append_object(cur_frame.object)
+            append_program_name(cur_frame.program_name)
+            append_file_name(file_name)
+            append_line_number(line_number)
+            append_eval_cost(eval_cost)
+            append_eval_time(cur_ns - last_ns)
+            append_variables(variables_idx)
+            last_ns = cur_ns
+        else:
+            ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
+            return
+
+        last_depth = cur_depth
+        last_level = level
+        last_size = size
+        memory.charge(size)
+        if memory.stopped:
+            ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
 
-    last_ns = time_ns()
     def hook(ob, instr):
-        nonlocal stack, last_ns
+        nonlocal last_ns
 
         # Safeguard
-        cur_depth = len(ldmud.call_stack)
+        call_stack = ldmud.call_stack
+        cur_depth = len(call_stack)
         if cur_depth < start_depth:
             ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
             return
@@ -303,37 +789,35 @@ def efun_trace_call(opts: trace_call_options, result: ldmud.Lvalue, fun: ldmud.C
         if max_depth and cur_depth > start_depth + max_depth:
             return
 
-        cur_frame = ldmud.call_stack[-1]
+        cur_frame = call_stack[-1]
         if cur_frame.type not in (ldmud.CALL_FRAME_TYPE_LFUN, ldmud.CALL_FRAME_TYPE_LAMBDA):
             return
 
-        cur_ns = time_ns()
-        step = Step(cur_frame, cur_ns - last_ns)
-        if not allow_frame(step):
+        if not allow_frame(cur_frame):
             return
 
-        if formatter is not None:
-            for name, var in cur_frame.variables.__dict__.items():
-                step.add_variable(name, formatter.format(var.value))
+        cur_ns = time_ns() - excluded_ns
+        eval_cost = cur_frame.eval_cost - excluded_eval_cost
 
-        parent_idx = cur_depth - start_depth
-        if len(stack) > parent_idx + 1:
-            stack = stack[:parent_idx+1]
-        elif len(stack) < parent_idx + 1:
-            stack.extend(None for _ in range(len(stack), parent_idx + 1))
-        while stack[parent_idx] is None:
-            parent_idx -= 1
+        if memory_budget:
+            record_step(cur_frame, cur_depth, cur_ns, eval_cost)
+            return
 
-        stack_entry = stack[parent_idx]
-        if not stack_entry:
-            stack_entry.append(step)
-            last_ns = cur_ns
-        elif allow_join(stack_entry[-1], step) and not stack_entry[-1].calls:
-            stack_entry[-1] = step
+        # Without a budget only the raw instruction is recorded,
+        # the TraceBuilder aggregates them after the call.
+        if formatter is not None:
+            append_variables(len(variables))
+            variables.append(capture(cur_frame))
         else:
-            stack_entry.append(step)
-            last_ns = cur_ns
-        stack.append(step.calls)
+            append_variables(-1)
+        append_depth(cur_depth)
+        append_object(cur_frame.object)
+        append_program_name(cur_frame.program_name)
+        append_file_name(cur_frame.file_name)
+        append_line_number(cur_frame.line_number or 0)
+        append_eval_cost(eval_cost)
+        append_eval_time(cur_ns - last_ns)
+        last_ns = cur_ns
 
     ldmud.register_hook(ldmud.BEFORE_INSTRUCTION, hook)
     try:
@@ -341,6 +825,38 @@ def efun_trace_call(opts: trace_call_options, result: ldmud.Lvalue, fun: ldmud.C
     finally:
         ldmud.unregister_hook(ldmud.BEFORE_INSTRUCTION, hook)
 
+    if defer_formatting:
+        elapsed_ns = time_ns() - start_ns - excluded_ns
+        elapsed_eval_cost = ldmud.call_stack[-1].eval_cost - start_eval_cost - excluded_eval_cost
+        if not (keep_min_time > 0 and elapsed_ns >= keep_min_time) and not (keep_min_eval_cost > 0 and elapsed_eval_cost >= keep_min_eval_cost):
+            return None
+
+    # Otherwise the variables were already formatted while recording.
+    if defer_formatting and formatter is not None:
+        format_variable = formatter.format
+    else:
+        format_variable = None
+
+    builder = TraceBuilder(tr, start_depth, 0 if memory_budget else granularity, format_variable)
+    # The steps don't form reference cycles, so there is no need to
+    # have the garbage collector scan the growing trace repeatedly.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for (ob, program_name, file_name, (depth, line_number, eval_cost, eval_time, variables_idx,),) in zip(objects, program_names, file_names, steps.records()):
+            frame = RecordedFrame(ob, program_name, file_name, line_number, eval_cost)
+            if variables_idx >= 0:
+                builder.add(frame, depth, eval_time, variables[variables_idx])
+                # Release the values, they are not needed anymore.
+                variables[variables_idx] = None
+            else:
+                builder.add(frame, depth, eval_time)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    if memory_budget:
+        tr.memory_usage = memory.usage
     return tr
 
 def register():
@@ -20,10 +20,14 @@ setuptools.setup(
     entry_points={
         'ldmud_efun': [
             'profile_call   = ldmud_tracing.profile:efun_profile_call',
+            'profile_call_tree = ldmud_tracing.profile:efun_profile_call_tree',
+            'profile_save   = ldmud_tracing.profile:efun_profile_save',
+            'profile_load   = ldmud_tracing.profile:efun_profile_load',
             'trace_call     = ldmud_tracing.tracing:efun_trace_call',
         ],
         'ldmud_type': [
             'profile_result = ldmud_tracing.profile:profile_result',
+            'profile_node   = ldmud_tracing.profile:profile_node',
             'trace_result   = ldmud_tracing.tracing:trace_result',
             'trace_cursor   = ldmud_tracing.tracing:trace_cursor',
         ]